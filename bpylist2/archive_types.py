@@ -1,5 +1,6 @@
 from datetime import datetime, timezone
-from typing import Optional
+import sys
+from typing import Any, Optional, Union, get_type_hints
 
 import dataclasses
 
@@ -8,22 +9,114 @@ class Error(Exception):
     pass
 
 
+_K_CLASS = sys.intern('$class')
+_K_NS_TIME = sys.intern('NS.time')
+
 _IGNORE_UNMAPPED_KEY = "__bpylist_ignore_unmapped__"
+_FIELDS_KEY = "__bpylist_fields__"
+_EXPECTED_KEYS_KEY = "__bpylist_expected_keys__"
+_CODEC_KEY = "__bpylist_codec__"
+
+
+def _archive_field_name(name):
+    if name[:2] == 'NS':
+        return 'NS.' + name[2:]
+    return name
+
+
+def _dataclass_fields(dataclass):
+    """Return (field name, archive key) pairs of a dataclass.
+
+    The pairs are computed on first use and cached on the class itself;
+    this can't happen in __init_subclass__, since the dataclass decorator
+    only runs after the class has been created.
+    """
+    fields = dataclass.__dict__.get(_FIELDS_KEY)
+    if fields is None:
+        fields = tuple((f.name, _archive_field_name(f.name))
+                       for f in dataclasses.fields(dataclass))
+        setattr(dataclass, _FIELDS_KEY, fields)
+        setattr(dataclass, _EXPECTED_KEYS_KEY,
+                frozenset([_K_CLASS, *(key for _, key in fields)]))
+    return fields
+
+
+def _bytes_if_bytearray(value):
+    if isinstance(value, bytearray):
+        return bytes(value)
+    return value
+
+
+def _may_hold_bytes(field_type):
+    "Whether a field of field_type may be decoded from a bytearray"
+    if field_type is Any:
+        return True
+    origin = getattr(field_type, '__origin__', None)
+    if origin is Union:
+        return any(_may_hold_bytes(arg) for arg in field_type.__args__)
+    if isinstance(origin, type):
+        field_type = origin
+    # play it safe with annotations we don't understand
+    return not isinstance(field_type, type) or issubclass(bytes, field_type)
+
+
+def _bytes_fields(dataclass):
+    "Names of the dataclass fields which may hold bytes"
+    try:
+        hints = get_type_hints(dataclass)
+    except (NameError, TypeError):
+        hints = {}
+    return frozenset(f.name for f in dataclasses.fields(dataclass)
+                     if _may_hold_bytes(hints.get(f.name, f.type)))
+
+
+def _dataclass_codec(dataclass):
+    """Return (encode, decode) functions specialized for a dataclass.
+
+    The functions are generated with the field names and archive keys
+    spelled out, much like dataclasses generates __init__, so that
+    (un)archiving an instance doesn't loop over the fields. Only fields
+    which may hold bytes are checked for bytearrays to convert.
+    """
+    codec = dataclass.__dict__.get(_CODEC_KEY)
+    if codec is not None:
+        return codec
+
+    fields = _dataclass_fields(dataclass)
+    bytes_fields = _bytes_fields(dataclass)
+    encoded = ''.join(f'        ({key!r}, obj.{name}),\n'
+                      for name, key in fields)
+    decoded = ''.join(
+        f'        {name}=_bytes_if_bytearray(decode({key!r})),\n'
+        if name in bytes_fields else
+        f'        {name}=decode({key!r}),\n'
+        for name, key in fields)
+    source = (
+        'def encode(obj, archive):\n'
+        '    archive.encode_many((\n'
+        f'{encoded}'
+        '    ))\n'
+        '\n'
+        'def decode(cls, archive):\n'
+        '    decode = archive.decode\n'
+        '    return cls(\n'
+        f'{decoded}'
+        '    )\n'
+    )
+    namespace = {'_bytes_if_bytearray': _bytes_if_bytearray}
+    exec(source, namespace)  # pylint: disable=exec-used
+
+    codec = (namespace['encode'], namespace['decode'])
+    setattr(dataclass, _CODEC_KEY, codec)
+    return codec
 
 
 def _verify_dataclass_has_fields(dataclass, plist_obj):
     if getattr(dataclass, _IGNORE_UNMAPPED_KEY, False):
         return
 
-    dataclass_fields = dataclasses.fields(dataclass)
-
-    skip_fields = {'$class'}
-
-    fields_to_verify = plist_obj.keys() - skip_fields
-    fields_with_no_dots = {
-        (f if not f.startswith('NS.') else 'NS' + f[3:])
-        for f in fields_to_verify}
-    unmapped_fields = fields_with_no_dots - {f.name for f in dataclass_fields}
+    _dataclass_fields(dataclass)
+    unmapped_fields = plist_obj.keys() - dataclass.__dict__[_EXPECTED_KEYS_KEY]
     if unmapped_fields:
         raise Error(
             f"Unmapped fields: {unmapped_fields} for class {dataclass}")
@@ -61,25 +154,14 @@ class DataclassArchiver:
 
     @staticmethod
     def encode_archive(obj, archive):
-        for field in dataclasses.fields(type(obj)):
-            archive_field_name = field.name
-            if archive_field_name[:2] == 'NS':
-                archive_field_name = 'NS.' + archive_field_name[2:]
-            archive.encode(archive_field_name, getattr(obj, field.name))
+        encode, _ = _dataclass_codec(type(obj))
+        encode(obj, archive)
 
     @classmethod
     def decode_archive(cls, archive):
         _verify_dataclass_has_fields(cls, archive.object)
-        field_values = {}
-        for field in dataclasses.fields(cls):
-            archive_field_name = field.name
-            if archive_field_name[:2] == 'NS':
-                archive_field_name = 'NS.' + archive_field_name[2:]
-            value = archive.decode(archive_field_name)
-            if isinstance(value, bytearray):
-                value = bytes(value)
-            field_values[field.name] = value
-        return cls(**field_values)
+        _, decode = _dataclass_codec(cls)
+        return decode(cls, archive)
 
 
 class timestamp(float):
@@ -108,12 +190,12 @@ class timestamp(float):
     def encode_archive(obj, archive):
         "Delegate for packing timestamps back into the NSDate archive format"
         offset = obj - timestamp.unix2apple_epoch_delta
-        archive.encode('NS.time', offset)
+        archive.encode(_K_NS_TIME, offset)
 
     @staticmethod
     def decode_archive(archive):
         "Delegate for unpacking NSDate objects from an archiver.Archive"
-        offset = archive.decode('NS.time')
+        offset = archive.decode(_K_NS_TIME)
         return timestamp(timestamp.unix2apple_epoch_delta + offset)
 
     def __str__(self):
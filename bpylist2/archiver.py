@@ -1,5 +1,5 @@
 import sys
-from typing import Mapping, Dict
+from typing import BinaryIO, Callable, Mapping, Dict, List, Optional, Union
 
 from bpylist2.archive_types import timestamp, NSMutableData
 
@@ -14,24 +14,63 @@ else:
 # Apple just likes to store a lot of zeros
 NSKeyedArchiveVersion = 100_000
 
+# The default limit on the number of objects in an archive, which keeps
+# crafted or runaway archives from exhausting memory
+DEFAULT_MAX_OBJECTS = 10_000_000
+
+# An upper bound on the plist objects per archived object that Unarchive
+# accepts from the plist trailer, before $objects is parsed and counted
+_PLIST_OBJECTS_PER_OBJECT = 16
+
+# Keys of the archive format, interned once so that all the dicts built and
+# searched by the (un)archiver share the same key objects
+_K_ARCHIVER = sys.intern('$archiver')
+_K_VERSION = sys.intern('$version')
+_K_TOP = sys.intern('$top')
+_K_ROOT = sys.intern('root')
+_K_OBJECTS = sys.intern('$objects')
+_K_CLASS = sys.intern('$class')
+_K_CLASSES = sys.intern('$classes')
+_K_CLASSNAME = sys.intern('$classname')
+_K_NS_KEYS = sys.intern('NS.keys')
+_K_NS_OBJECTS = sys.intern('NS.objects')
+
 # Cached for convenience
 NULL_UID = plistlib.UID(0)
 
+# UIDs are never modified, so the ones for small indices, which every archive
+# uses, are shared rather than allocated for each archived object
+_SMALL_UIDS = [plistlib.UID(i) for i in range(1024)]
+
+
+def _uid(index: int) -> plistlib.UID:
+    if index < 1024:
+        return _SMALL_UIDS[index]
+    return plistlib.UID(index)
+
+
+# Anything plistlib can parse an archive from
+Buffer = Union[bytes, bytearray, memoryview]
 
-def unarchive(plist: bytes) -> object:
+
+def unarchive(plist: Buffer,
+              max_objects: int = DEFAULT_MAX_OBJECTS) -> object:
     "Unpack an NSKeyedArchived byte blob into a more useful object tree."
-    return Unarchive(plist).top_object()
+    return Unarchive(plist, max_objects).top_object()
 
 
-def unarchive_file(path: str) -> object:
+def unarchive_file(path: str,
+                   max_objects: int = DEFAULT_MAX_OBJECTS) -> object:
     """Loads an archive from a file path."""
     with open(path, 'rb') as fd:
-        return unarchive(fd.read())
+        # plistlib seeks to and reads each object from the file as needed,
+        # so the file is never held in memory as a whole
+        return Unarchive(fd, max_objects).top_object()
 
 
-def archive(obj: object) -> bytes:
+def archive(obj: object, max_objects: int = DEFAULT_MAX_OBJECTS) -> bytes:
     "Pack an object tree into an NSKeyedArchived blob."
-    return Archive(obj).to_bytes()
+    return Archive(obj, max_objects).to_bytes()
 
 
 class ArchiverError(Exception):
@@ -45,52 +84,103 @@ class UnsupportedArchiver(ArchiverError):
     """
 
     def __init__(self, alternate):
-        super().__init__(f"unsupported encoder: `{alternate}'")
+        super().__init__(alternate)
+        self.alternate = alternate
+
+    def __str__(self):
+        return f"unsupported encoder: `{self.alternate}'"
 
 
 class UnsupportedArchiveVersion(ArchiverError):
     def __init__(self, version):
-        super().__init__(f"expected {NSKeyedArchiveVersion}, got `{version}'")
+        super().__init__(version)
+        self.version = version
+
+    def __str__(self):
+        return f"expected {NSKeyedArchiveVersion}, got `{self.version}'"
 
 
 class MissingTopObject(ArchiverError):
     def __init__(self, plist):
-        super().__init__(f"no top object! plist dump: {plist}")
+        super().__init__(plist)
+        self.plist = plist
+
+    def __str__(self):
+        return f"no top object! plist dump: {self.plist}"
 
 
 class MissingTopObjectUID(ArchiverError):
     def __init__(self, top):
-        super().__init__(f"top object did not have a UID! dump: {top}")
+        super().__init__(top)
+        self.top = top
+
+    def __str__(self):
+        return f"top object did not have a UID! dump: {self.top}"
 
 
 class MissingObjectsArray(ArchiverError):
     def __init__(self, plist):
-        super().__init__(f"full plist dump: `{plist}'")
+        super().__init__(plist)
+        self.plist = plist
+
+    def __str__(self):
+        return f"full plist dump: `{self.plist}'"
 
 
 class MissingClassMetaData(ArchiverError):
     def __init__(self, index, result):
-        super().__init__(f"$class had no metadata {index}: {result}")
+        super().__init__(index, result)
+        self.index = index
+        self.result = result
+
+    def __str__(self):
+        return f"$class had no metadata {self.index}: {self.result}"
 
 
 class MissingClassName(ArchiverError):
     def __init__(self, meta):
-        super().__init__(f"$class had no $classname; $class = {meta}")
+        super().__init__(meta)
+        self.meta = meta
+
+    def __str__(self):
+        return f"$class had no $classname; $class = {self.meta}"
 
 
 class MissingClassUID(ArchiverError):
     def __init__(self, obj):
-        super().__init__(f"object has no $class: {obj}")
+        super().__init__(obj)
+        self.obj = obj
+
+    def __str__(self):
+        return f"object has no $class: {self.obj}"
 
 
 class CircularReference(ArchiverError):
     def __init__(self, index):
-        super().__init__(f"archive has a cycle with {index}")
+        super().__init__(index)
+        self.index = index
+
+    def __str__(self):
+        return f"archive has a cycle with {self.index}"
 
 
 class MissingClassMapping(ArchiverError):
     def __init__(self, name, mapping):
-        super().__init__(f"no mapping for {name} in {mapping}")
+        super().__init__(name, mapping)
+        self.name = name
+        self.mapping = mapping
+
+    def __str__(self):
+        return f"no mapping for {self.name} in {self.mapping}"
+
+
+class TooManyObjects(ArchiverError):
+    def __init__(self, limit):
+        super().__init__(limit)
+        self.limit = limit
+
+    def __str__(self):
+        return f"archive has more than {self.limit} objects"
 
 
 class DictArchive:
@@ -98,18 +188,10 @@ class DictArchive:
 
     @staticmethod
     def decode_archive(archive_obj):
-        key_uids = archive_obj.decode('NS.keys')
-        val_uids = archive_obj.decode('NS.objects')
-
-        count = len(key_uids)
-        d = {}
-
-        for i in range(count):
-            key = archive_obj.decode_index(key_uids[i])
-            val = archive_obj.decode_index(val_uids[i])
-            d[key] = val
-
-        return d
+        decode = archive_obj.decode_index
+        key_uids = archive_obj.object[_K_NS_KEYS]
+        val_uids = archive_obj.object[_K_NS_OBJECTS]
+        return {decode(k): decode(v) for k, v in zip(key_uids, val_uids)}
 
 
 class ListArchive:
@@ -117,8 +199,8 @@ class ListArchive:
 
     @staticmethod
     def decode_archive(archive_obj):
-        uids = archive_obj.decode('NS.objects')
-        return [archive_obj.decode_index(index) for index in uids]
+        decode = archive_obj.decode_index
+        return [decode(index) for index in archive_obj.object[_K_NS_OBJECTS]]
 
 
 class SetArchive:
@@ -126,8 +208,13 @@ class SetArchive:
 
     @staticmethod
     def decode_archive(archive_obj):
-        uids = archive_obj.decode('NS.objects')
-        return {archive_obj.decode_index(index) for index in uids}
+        decode = archive_obj.decode_index
+        return {decode(index) for index in archive_obj.object[_K_NS_OBJECTS]}
+
+
+# delegates which decode every object their archived object references, so
+# the unarchiver can decode those objects up front
+_CONTAINER_DELEGATES = (DictArchive, ListArchive, SetArchive)
 
 
 class ArchivedObject:
@@ -139,19 +226,31 @@ class ArchivedObject:
     this class is decode(self, key).
     """
 
-    def __init__(self, obj, unarchiver):
+    def __init__(self, obj: dict, unarchiver: 'Unarchive') -> None:
         self.object = obj
         self._unarchiver = unarchiver
-
-    def decode_index(self, index: plistlib.UID):
-        return self._unarchiver.decode_object(index)
+        # bound directly to skip a wrapper call per decoded element
+        self.decode_index: Callable[[plistlib.UID], object] = \
+            unarchiver.decode_object
 
     def decode(self, key: str):
         return self._unarchiver.decode_key(self.object, key)
 
 
-class CycleToken:
-    "token used in Unarchive's unpacked_uids cache to help detect cycles"
+# markers used in Unarchive's unpacked_cache: _UNSET for objects which have
+# not been decoded yet, _CYCLE for objects which are being decoded right now
+# (to help detect cycles)
+_UNSET = object()
+_CYCLE = object()
+
+
+class _Failed:
+    "marks an object in Unarchive's unpacked_cache which failed to decode"
+
+    __slots__ = ('error',)
+
+    def __init__(self, error):
+        self.error = error
 
 
 class Unarchive:
@@ -173,44 +272,100 @@ class Unarchive:
     is non-trivial, and I don't want to have a mess of special cases.
     """
 
-    def __init__(self, input_bytes: bytes) -> None:
+    def __init__(self, input_bytes: Union[Buffer, BinaryIO],
+                 max_objects: int = DEFAULT_MAX_OBJECTS) -> None:
         self.input = input_bytes
-        self.unpacked_uids: Dict[plistlib.UID, object] = {}
+        self.max_objects = max_objects
+        self.unpacked_cache: List[object] = []
+        self.class_cache: List[Optional[type]] = []
         self.top_uid = NULL_UID
         self.objects: list = []
 
+    def check_trailer(self):
+        """
+        Refuse grossly oversized archives before plistlib allocates them.
+
+        The trailer of a binary plist has its number of plist objects in it;
+        the count includes keys, UIDs and values, hence the leeway before
+        the actual limit is checked on $objects.
+        """
+
+        if isinstance(self.input, (bytes, bytearray, memoryview)):
+            header, size = self.input[:8], len(self.input)
+            trailer = self.input[-32:]
+        else:
+            header, size = self.input.read(8), self.input.seek(0, 2)
+            self.input.seek(size - 32 if size >= 32 else 0)
+            trailer = self.input.read(32)
+            self.input.seek(0)
+        if header == b'bplist00' and size >= 40:
+            offset_size = trailer[6]
+            count = int.from_bytes(trailer[8:16], 'big')
+            table_offset = int.from_bytes(trailer[24:32], 'big')
+            # a count whose offset table can't fit in the input comes from a
+            # truncated or corrupt plist rather than an oversized archive
+            if not offset_size or \
+                    table_offset + count * offset_size > size - 32:
+                raise plistlib.InvalidFileException()
+            if count > self.max_objects * _PLIST_OBJECTS_PER_OBJECT:
+                raise TooManyObjects(self.max_objects)
+
     def unpack_archive_header(self):
-        plist = plistlib.loads(self.input)
+        self.check_trailer()
 
-        archiver = plist.get('$archiver')
+        # archives are always binary plists, plistlib can't even represent
+        # UIDs in XML, so there is no need to detect the format; files are
+        # parsed in place, plistlib seeks to each object as it needs it
+        # pylint: disable=no-member
+        if isinstance(self.input, (bytes, bytearray, memoryview)):
+            plist = plistlib.loads(
+                self.input, fmt=plistlib.FMT_BINARY)  # type: ignore
+        else:
+            plist = plistlib.load(
+                self.input, fmt=plistlib.FMT_BINARY)  # type: ignore
+        # pylint: enable=no-member
+
+        archiver = plist.get(_K_ARCHIVER)
         if archiver != 'NSKeyedArchiver':
             raise UnsupportedArchiver(archiver)
 
-        version = plist.get('$version')
+        version = plist.get(_K_VERSION)
         if version != NSKeyedArchiveVersion:
             raise UnsupportedArchiveVersion(version)
 
-        top = plist.get('$top')
+        top = plist.get(_K_TOP)
         if not isinstance(top, dict):
             raise MissingTopObject(plist)
 
-        top_uid = top.get('root')
+        top_uid = top.get(_K_ROOT)
         if top_uid is None:
             raise MissingTopObjectUID(top)
         self.top_uid = top_uid
 
-        self.objects = plist.get('$objects')
+        self.objects = plist.get(_K_OBJECTS)
         if not isinstance(self.objects, list):
             raise MissingObjectsArray(plist)
 
+        if len(self.objects) > self.max_objects:
+            raise TooManyObjects(self.max_objects)
+
+        # decoded objects, indexed by uid
+        self.unpacked_cache = [_UNSET] * len(self.objects)
+        # unarchiving delegates, indexed by the uid of their class metadata
+        self.class_cache = [None] * len(self.objects)
+
     def class_for_uid(self, index: plistlib.UID):
         "use the UNARCHIVE_CLASS_MAP to find the unarchiving delegate of a uid"
 
+        klass = self.class_cache[index.data]
+        if klass is not None:
+            return klass
+
         meta = self.objects[index.data]
         if not isinstance(meta, dict):
             raise MissingClassMetaData(index, meta)
 
-        name = meta.get('$classname')
+        name = meta.get(_K_CLASSNAME)
         if not isinstance(name, str):
             raise MissingClassName(meta)
 
@@ -218,6 +373,7 @@ class Unarchive:
         if klass is None:
             raise MissingClassMapping(name, UNARCHIVE_CLASS_MAP)
 
+        self.class_cache[index.data] = klass
         return klass
 
     def decode_key(self, obj, key):
@@ -229,36 +385,119 @@ class Unarchive:
     def decode_object(self, index: plistlib.UID):
         # index 0 always points to the $null object, which is the archive's
         # special way of saying the value is null/nil/none
-        if index == NULL_UID:
+        i = index.data
+        if i == 0:
             return None
 
-        obj = self.unpacked_uids.get(index)
-        if obj == CycleToken:
+        cached = self.unpacked_cache[i]
+        if cached is _CYCLE:
             raise CircularReference(index)
 
-        if obj is not None:
-            return obj
+        if cached is not _UNSET:
+            if cached.__class__ is _Failed:
+                raise cached.error
+            return cached
 
-        raw_obj = self.objects[index.data]
+        self.decode_tree(i)
+        return self.unpacked_cache[i]
 
-        # put a temp object in place, in case we have a circular
-        # reference, which we do not really support
-        self.unpacked_uids[index] = CycleToken
-
-        # if obj is a (semi-)primitive type (e.g. str)
-        if not isinstance(raw_obj, dict):
-            self.unpacked_uids[index] = obj
-            return raw_obj
-
-        class_uid = raw_obj.get('$class')
-        if class_uid is None:
-            raise MissingClassUID(raw_obj)
+    def decode_tree(self, root: int):
+        """
+        Decode the object at index root along with everything it references.
+
+        Objects are decoded with an explicit stack instead of recursion,
+        children before their parents, so that deeply nested archives can't
+        exhaust the interpreter stack and delegates find the objects they
+        decode already in unpacked_cache.
+
+        Only the children of the built-in containers are decoded this way,
+        as their delegates always ask for all of them; other delegates decode
+        what they need on demand. A child which is part of a cycle or fails
+        to decode keeps its error in unpacked_cache, so the error is raised
+        when the delegate asks for it, without decoding the child again.
+        """
 
-        klass = self.class_for_uid(class_uid)
-        obj = klass.decode_archive(ArchivedObject(raw_obj, self))
+        cache = self.unpacked_cache
+        objects = self.objects
+
+        # an index to visit an object and schedule its children, or its
+        # complement (~index) to run its delegate once the children are done
+        stack = [root]
+        while stack:
+            i = stack.pop()
+
+            if i >= 0:
+                if cache[i] is not _UNSET:
+                    continue
+
+                raw_obj = objects[i]
+
+                # if obj is a (semi-)primitive type (e.g. str)
+                if not isinstance(raw_obj, dict):
+                    cache[i] = raw_obj
+                    continue
+
+                # put a temp object in place, in case we have a circular
+                # reference, which we do not really support
+                cache[i] = _CYCLE
+                stack.append(~i)
+                if self.is_container(raw_obj):
+                    self.schedule_children(raw_obj, stack)
+                continue
+
+            i = ~i
+            raw_obj = objects[i]
+            try:
+                class_uid = raw_obj.get(_K_CLASS)
+                if class_uid is None:
+                    raise MissingClassUID(raw_obj)
+
+                klass = self.class_for_uid(class_uid)
+                cache[i] = klass.decode_archive(ArchivedObject(raw_obj, self))
+            except Exception as error:  # pylint: disable=broad-except
+                # never leave the _CYCLE marker behind: a later attempt
+                # would report a cycle instead of the actual error
+                cache[i] = _Failed(error)
+                if i == root:
+                    raise
+
+    def is_container(self, raw_obj) -> bool:
+        "whether raw_obj is decoded by one of the built-in container delegates"
+
+        class_uid = raw_obj.get(_K_CLASS)
+        if not isinstance(class_uid, plistlib.UID):
+            return False
+        try:
+            klass = self.class_for_uid(class_uid)
+        except (ArchiverError, IndexError):
+            # reported when the object itself is decoded
+            return False
+        return klass in _CONTAINER_DELEGATES
+
+    def schedule_children(self, raw_obj, stack):
+        """
+        Push the elements of the container raw_obj which still need decoding
+        onto the decode_tree stack; primitives are decoded right away instead.
+        """
 
-        self.unpacked_uids[index] = obj
-        return obj
+        cache = self.unpacked_cache
+        objects = self.objects
+        count = len(objects)
+
+        for key in (_K_NS_KEYS, _K_NS_OBJECTS):
+            uids = raw_obj.get(key)
+            if not isinstance(uids, list):
+                continue
+            for uid in uids:
+                if not isinstance(uid, plistlib.UID):
+                    continue
+                child = uid.data
+                if 0 < child < count and cache[child] is _UNSET:
+                    raw_child = objects[child]
+                    if isinstance(raw_child, dict):
+                        stack.append(child)
+                    else:
+                        cache[child] = raw_child
 
     def top_object(self):
         "recursively decode the root/top object and return the result"
@@ -273,7 +512,8 @@ class ArchivingObject:
 
     This is the object that will be passed to unarchiving delegates
     so that they can do their part in constructing the archive. The
-    only useful method on this class is encode(self, key, val).
+    only useful methods on this class are encode(self, key, val) and
+    encode_many(self, items).
     """
 
     def __init__(self, archive_obj, archiver):
@@ -284,6 +524,13 @@ class ArchivingObject:
         val = self._archiver.encode(val)
         self._archive_obj[key] = val
 
+    def encode_many(self, items):
+        "Like encode(self, key, val), for an iterable of (key, val) pairs."
+        encode = self._archiver.encode
+        archive_obj = self._archive_obj
+        for key, val in items:
+            archive_obj[key] = encode(val)
+
 
 class Archive:
     """
@@ -298,21 +545,33 @@ class Archive:
     """
 
     # types which do not require the "object" encoding for an archive;
-    primitive_types = [int, float, bool, str, bytes, plistlib.UID]
+    primitive_types = frozenset([int, float, bool, str, bytes, plistlib.UID])
 
     # types which require no extra encoding at all, they can be inlined
     # in the archive
-    inline_types = [int, float, bool]
+    inline_types = frozenset([int, float, bool])
 
-    def __init__(self, input_obj):
+    def __init__(self, input_obj, max_objects=DEFAULT_MAX_OBJECTS):
         self.input = input_obj
+        self.max_objects = max_objects
         # cache/map class names (str) to uids
         self.class_map = {}
         # cache/map of already archived objects to uids (to avoid cycles)
         self.ref_map = {}
+        # keeps the objects in ref_map which are not in objects alive, so
+        # that their ids can't be reused by temporaries created while archiving
+        self.ref_objects = []
         # objects that go directly into the archive, always start with $null
         self.objects = ['$null']
 
+    def next_uid(self) -> plistlib.UID:
+        "Return the UID of the next object added to the archive."
+
+        index = len(self.objects)
+        if index >= self.max_objects:
+            raise TooManyObjects(self.max_objects)
+        return _uid(index)
+
     def uid_for_archiver(self, archiver: type) -> plistlib.UID:
         """
         Ensure the class definition for the archiver is included in the arcive.
@@ -330,73 +589,81 @@ class Archive:
         if val:
             return val
 
-        val = plistlib.UID(len(self.objects))
+        val = self.next_uid()
         self.class_map[archiver] = val
 
         # TODO: this is where we might need to include the full class ancestry;
         #       though the open source code from apple does not appear to check
         self.objects.append({
-            '$classes': [archiver],
-            '$classname': archiver
+            _K_CLASSES: [archiver],
+            _K_CLASSNAME: archiver
         })
 
         return val
 
     def encode(self, val):
+        if val is None:
+            return NULL_UID
+
         cls = val.__class__
 
         if cls in Archive.inline_types:
             return val
 
+        # strings are the bulk of most archives, so this is archive() minus
+        # everything which isn't needed for them
+        if cls is str or cls is bytes:
+            oid = id(val)
+            ref = self.ref_map.get(oid)
+            if ref is None:
+                ref = self.next_uid()
+                self.ref_map[oid] = ref
+                self.objects.append(val)
+            return ref
+
         return self.archive(val)
 
-    def encode_list(self, objs, archive_obj):
+    def encode_list(self, objs):
         archiver_uid = self.uid_for_archiver('NSArray')
-        archive_obj['$class'] = archiver_uid
-        archive_obj['NS.objects'] = [self.archive(obj) for obj in objs]
+        archive_uid = self.archive
+        return {_K_CLASS: archiver_uid,
+                _K_NS_OBJECTS: [archive_uid(obj) for obj in objs]}
 
-    def encode_set(self, objs, archive_obj):
+    def encode_set(self, objs):
         archiver_uid = self.uid_for_archiver('NSSet')
-        archive_obj['$class'] = archiver_uid
-        archive_obj['NS.objects'] = [self.archive(obj) for obj in objs]
+        archive_uid = self.archive
+        return {_K_CLASS: archiver_uid,
+                _K_NS_OBJECTS: [archive_uid(obj) for obj in objs]}
 
-    def encode_dict(self, obj, archive_obj):
+    def encode_dict(self, obj):
         archiver_uid = self.uid_for_archiver('NSDictionary')
-        archive_obj['$class'] = archiver_uid
-
-        keys = []
-        vals = []
-        for k in obj:
-            keys.append(self.archive(k))
-            vals.append(self.archive(obj[k]))
-
-        archive_obj['NS.keys'] = keys
-        archive_obj['NS.objects'] = vals
+        archive_uid = self.archive
+        items = obj.items()
+        return {_K_CLASS: archiver_uid,
+                _K_NS_KEYS: [archive_uid(k) for k, _ in items],
+                _K_NS_OBJECTS: [archive_uid(v) for _, v in items]}
+
+    # encoders for the builtin containers, by type
+    builtin_encoders = {
+        list: encode_list,
+        dict: encode_dict,
+        set: encode_set,
+    }
 
     def encode_top_level(self, obj, archive_obj):
-        "Encode obj and store the encoding in archive_obj"
+        "Encode obj of a mapped class and store the encoding in archive_obj"
 
         cls = obj.__class__
 
-        if cls == list:
-            self.encode_list(obj, archive_obj)
+        archiver = ARCHIVE_CLASS_MAP.get(cls)
+        if archiver is None:
+            raise MissingClassMapping(obj, ARCHIVE_CLASS_MAP)
 
-        elif cls == dict:
-            self.encode_dict(obj, archive_obj)
+        archiver_uid = self.uid_for_archiver(archiver)
+        archive_obj[_K_CLASS] = archiver_uid
 
-        elif cls == set:
-            self.encode_set(obj, archive_obj)
-
-        else:
-            archiver = ARCHIVE_CLASS_MAP.get(cls)
-            if archiver is None:
-                raise MissingClassMapping(obj, ARCHIVE_CLASS_MAP)
-
-            archiver_uid = self.uid_for_archiver(archiver)
-            archive_obj['$class'] = archiver_uid
-
-            archive_wrapper = ArchivingObject(archive_obj, self)
-            cls.encode_archive(obj, archive_wrapper)
+        archive_wrapper = ArchivingObject(archive_obj, self)
+        cls.encode_archive(obj, archive_wrapper)
 
     def archive(self, obj) -> plistlib.UID:
         "Add the encoded form of obj to the archive, returning the UID of obj."
@@ -406,18 +673,31 @@ class Archive:
 
         # the ref_map allows us to avoid infinite recursion caused by
         # cycles in the object graph by functioning as a sort of promise
-        ref = self.ref_map.get(id(obj))
-        if ref:
+        oid = id(obj)
+        ref_map = self.ref_map
+        ref = ref_map.get(oid)
+        if ref is not None:
             return ref
 
-        index = plistlib.UID(len(self.objects))
-        self.ref_map[id(obj)] = index
+        index = self.next_uid()
+        ref_map[oid] = index
 
         cls = obj.__class__
         if cls in Archive.primitive_types:
+            # kept alive by self.objects
             self.objects.append(obj)
             return index
 
+        self.ref_objects.append(obj)
+
+        encoder = Archive.builtin_encoders.get(cls)
+        if encoder is not None:
+            # hold the index until the elements have been archived, so that
+            # the encoding can be built in one go
+            self.objects.append(None)
+            self.objects[index.data] = encoder(self, obj)
+            return index
+
         archive_obj: Dict[str, object] = {}
         self.objects.append(archive_obj)
         self.encode_top_level(obj, archive_obj)
@@ -431,11 +711,17 @@ class Archive:
         if len(self.objects) == 1:
             self.archive(self.input)
 
+            # the maps are only needed while the object graph is walked;
+            # let them go before plistlib builds its own copy of the archive
+            self.class_map.clear()
+            self.ref_map.clear()
+            self.ref_objects.clear()
+
         d = {
-            '$archiver': 'NSKeyedArchiver',
-            '$version': NSKeyedArchiveVersion,
-            '$objects': self.objects,
-            '$top': {'root': plistlib.UID(1)}
+            _K_ARCHIVER: 'NSKeyedArchiver',
+            _K_VERSION: NSKeyedArchiveVersion,
+            _K_OBJECTS: self.objects,
+            _K_TOP: {_K_ROOT: _uid(1)}
         }
         # pylint: disable=no-member
         return plistlib.dumps(
@@ -1,13 +1,18 @@
+import functools
 import json
 from typing import Iterator
 
 from os.path import dirname, join
 
 
-def get_fixture(name: str) -> bytes:
+def get_fixture_path(name: str) -> str:
     fixture_dir = join(dirname(__file__), 'fixture_data')
-    fixture_file = join(fixture_dir, name)
-    with open(fixture_file, 'rb') as f:
+    return join(fixture_dir, name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_fixture(name: str) -> bytes:
+    with open(get_fixture_path(name), 'rb') as f:
         return f.read()
 
 
@@ -1,11 +1,14 @@
+import contextlib
 import dataclasses
 from datetime import datetime, timezone
 import sys
+from typing import Any, ClassVar, List, Optional
 import unittest
+from unittest import mock
 
 from bpylist2 import archiver, archive_types
 from bpylist2.archive_types import timestamp, NSMutableData
-from tests.fixtures import get_fixture
+from tests.fixtures import get_fixture, get_fixture_path
 
 if sys.version_info < (3, 8, 0):
     # pylint: disable=ungrouped-imports
@@ -15,23 +18,15 @@ else:
     import plistlib  # type: ignore
 
 
+@dataclasses.dataclass
 class FooArchive:
-
-    def __init__(self, title, stamp, count, cats, meta, empty, recursive):
-        self.title = title
-        self.stamp = stamp
-        self.count = count
-        self.categories = cats
-        self.metadata = meta
-        self.empty = empty
-        self.recursive = recursive
-
-    def __eq__(self, other):
-        for field in ['title', 'stamp', 'count', 'categories', 'metadata',
-                      'empty', 'recursive']:
-            if getattr(self, field) != getattr(other, field):
-                return False
-        return True
+    title: Any
+    stamp: Any
+    count: Any
+    categories: Any
+    metadata: Any
+    empty: Any
+    recursive: Any
 
     @staticmethod
     def encode_archive(obj, archive):
@@ -55,7 +50,44 @@ class FooArchive:
         return FooArchive(title, stamp, count, cats, meta, empty, recurse)
 
 
-archiver.update_class_map({'crap.Foo': FooArchive})
+@dataclasses.dataclass
+class TemporariesArchive:
+    first: int
+    second: int
+
+    @staticmethod
+    def encode_archive(obj, archive):
+        # the lists are garbage as soon as they are encoded
+        archive.encode('first', [obj.first])
+        archive.encode('second', [obj.second])
+
+    @staticmethod
+    def decode_archive(archive):
+        return TemporariesArchive(archive.decode('first')[0],
+                                  archive.decode('second')[0])
+
+
+@dataclasses.dataclass
+class NodeArchive:
+    name: str
+    first: Any = None
+    second: Any = None
+
+    # names of the decoded nodes, to check that shared nodes are decoded once
+    decoded: ClassVar[List[str]] = []
+
+    @staticmethod
+    def encode_archive(obj, archive):
+        archive.encode('name', obj.name)
+        archive.encode('first', obj.first)
+        archive.encode('second', obj.second)
+
+    @staticmethod
+    def decode_archive(archive):
+        name = archive.decode('name')
+        NodeArchive.decoded.append(name)
+        return NodeArchive(name, archive.decode('first'),
+                           archive.decode('second'))
 
 
 @dataclasses.dataclass
@@ -78,9 +110,68 @@ class DataclassIgnoreMissingFields(
     int_field: int = 0
 
 
-archiver.update_class_map({
-    'FooDataclass': FooDataclass,
-})
+@dataclasses.dataclass
+class FooDataclassChild(FooDataclass):
+    NSchild_field: str = ""
+
+
+class ByteArrayArchive:
+    "Archives bytes, which are unarchived as a bytearray"
+
+    def __init__(self, data):
+        self.data = data
+
+    @staticmethod
+    def encode_archive(obj, archive):
+        archive.encode('NS.bytes', obj.data)
+
+    @staticmethod
+    def decode_archive(archive):
+        return bytearray(archive.decode('NS.bytes'))
+
+
+@dataclasses.dataclass
+class DataclassBytesFields(archive_types.DataclassArchiver):
+    data: bytes = b''
+    maybe_data: Optional[bytes] = None
+    any_data: Any = None
+    not_data: Optional[bytearray] = None
+
+
+@contextlib.contextmanager
+def temp_class_map(updates, remove=()):
+    "Change the archiver's class maps only for the duration of the block"
+    saved = [(class_map, dict(class_map)) for class_map in
+             (archiver.UNARCHIVE_CLASS_MAP, archiver.ARCHIVE_CLASS_MAP)]
+    try:
+        archiver.update_class_map(updates)
+        for name in remove:
+            del archiver.UNARCHIVE_CLASS_MAP[name]
+        yield
+    finally:
+        for class_map, contents in saved:
+            class_map.clear()
+            class_map.update(contents)
+
+
+# the test classes are registered for the tests of this module only
+_class_maps = contextlib.ExitStack()
+
+
+def setUpModule():
+    _class_maps.enter_context(temp_class_map({
+        'crap.Foo': FooArchive,
+        'Temporaries': TemporariesArchive,
+        'Node': NodeArchive,
+        'FooDataclass': FooDataclass,
+        'FooDataclassChild': FooDataclassChild,
+        'DataclassBytesFields': DataclassBytesFields,
+        'ByteArray': ByteArrayArchive,
+    }))
+
+
+def tearDownModule():
+    _class_maps.close()
 
 
 class UnarchiveTest(unittest.TestCase):
@@ -121,12 +212,10 @@ class UnarchiveTest(unittest.TestCase):
             self.unarchive('no_class_name')
 
     def test_complains_about_unmapped_classes(self):
-        del archiver.UNARCHIVE_CLASS_MAP['crap.Foo']
-
-        with self.assertRaises(archiver.MissingClassMapping):
-            self.unarchive('simple')
-
-        archiver.update_class_map({'crap.Foo': FooArchive})
+        with temp_class_map({}, remove=['crap.Foo']):
+            with self.assertRaises(archiver.MissingClassMapping) as cm:
+                self.unarchive('simple')
+        self.assertIn('no mapping for crap.Foo', str(cm.exception))
 
     def test_complains_about_missing_class_uid(self):
         with self.assertRaises(archiver.MissingClassUID):
@@ -175,6 +264,125 @@ class UnarchiveTest(unittest.TestCase):
         with self.assertRaises(archiver.CircularReference):
             self.unarchive('circular')
 
+    def test_unpack_deeply_nested_archive(self):
+        depth = 10_000
+        # $null, the NSArray class, then each array containing the next one
+        objects = ['$null', {'$classes': ['NSArray'],
+                             '$classname': 'NSArray'}]
+        for i in range(depth):
+            children = [plistlib.UID(i + 3)] if i < depth - 1 else []
+            objects.append({'$class': plistlib.UID(1),
+                            'NS.objects': children})
+        plist = plistlib.dumps({
+            '$archiver': 'NSKeyedArchiver',
+            '$version': archiver.NSKeyedArchiveVersion,
+            '$objects': objects,
+            '$top': {'root': plistlib.UID(2)},
+        }, fmt=plistlib.FMT_BINARY)
+
+        obj = archiver.unarchive(plist)
+        for _ in range(depth - 1):
+            obj, = obj
+        self.assertEqual([], obj)
+
+    def test_unpack_ignores_unused_broken_objects(self):
+        plist = plistlib.loads(self.fixture('dataclass'))
+        dataclass_obj = plist['$objects'][plist['$top']['root'].data]
+        dataclass_obj['unmapped'] = plistlib.UID(len(plist['$objects']))
+        plist['$objects'].append({'$class': plistlib.UID(0)})
+        plist = plistlib.dumps(plist, fmt=plistlib.FMT_BINARY)
+
+        with temp_class_map({'FooDataclass': DataclassIgnoreMissingFields}):
+            expected = DataclassIgnoreMissingFields(int_field=5)
+            actual = archiver.unarchive(plist)
+            self.assertEqual(actual, expected)
+
+    def test_unpack_skips_unused_objects(self):
+        plist = archiver.archive(
+            FooDataclass(int_field=5, list_field=[NodeArchive('unused')]))
+
+        NodeArchive.decoded.clear()
+        with temp_class_map({'FooDataclass': DataclassIgnoreMissingFields}):
+            actual = archiver.unarchive(plist)
+        self.assertEqual(DataclassIgnoreMissingFields(int_field=5), actual)
+        self.assertEqual([], NodeArchive.decoded)
+
+    def test_unpack_file(self):
+        obj = archiver.unarchive_file(get_fixture_path('simple_archive.plist'))
+        self.assertEqual('yo', obj.title)
+        self.assertEqual(42, obj.count)
+
+    def test_complains_about_too_many_objects(self):
+        # 13 archived objects: $null, the list, its class and 10 strings
+        obj = [str(i) for i in range(10)]
+        plist = archiver.archive(obj, max_objects=13)
+        self.assertEqual(obj, archiver.unarchive(plist, max_objects=13))
+
+        with self.assertRaises(archiver.TooManyObjects):
+            archiver.archive(obj, max_objects=12)
+        with self.assertRaises(archiver.TooManyObjects):
+            archiver.unarchive(plist, max_objects=12)
+
+    def test_complains_about_too_many_plist_objects(self):
+        # a single archived object made of 200 plist objects, which is
+        # refused before $objects is even parsed
+        fields = {f'field{i}': i for i in range(100)}
+        plist = plistlib.dumps({
+            '$archiver': 'NSKeyedArchiver',
+            '$version': archiver.NSKeyedArchiveVersion,
+            '$objects': ['$null', dict(fields, **{'$class': plistlib.UID(2)}),
+                         {'$classes': ['Foo'], '$classname': 'Foo'}],
+            '$top': {'root': plistlib.UID(1)},
+        }, fmt=plistlib.FMT_BINARY)
+        with self.assertRaises(archiver.TooManyObjects):
+            archiver.unarchive(plist, max_objects=3)
+
+    def test_complains_about_truncated_plists(self):
+        plist = archiver.archive(['a'])
+        for size in range(len(plist) - 8, len(plist)):
+            with self.subTest(size=size):
+                with self.assertRaises(plistlib.InvalidFileException):
+                    archiver.unarchive(plist[:size])
+
+    def test_complains_about_non_binary_plists(self):
+        with self.assertRaises(plistlib.InvalidFileException):
+            archiver.unarchive(b'garbage' * 10)
+
+    def test_unpack_reports_nested_errors(self):
+        plist = archiver.archive(
+            {'node': NodeArchive('node', TemporariesArchive(1, 2))})
+        with temp_class_map({}, remove=['Temporaries']):
+            with self.assertRaises(archiver.MissingClassMapping):
+                archiver.unarchive(plist)
+
+    def test_unpack_reports_deeply_nested_errors_once(self):
+        obj = TemporariesArchive(1, 2)
+        for _ in range(30):
+            obj = [obj]
+        plist = archiver.archive(obj)
+
+        class_for_uid = archiver.Unarchive.class_for_uid
+        with temp_class_map({}, remove=['Temporaries']), \
+                mock.patch.object(archiver.Unarchive, 'class_for_uid',
+                                  autospec=True,
+                                  side_effect=class_for_uid) as spy:
+            with self.assertRaises(archiver.MissingClassMapping):
+                archiver.unarchive(plist)
+        # a few lookups per object, not twice as many per level of nesting
+        self.assertLess(spy.call_count, 100)
+
+    def test_unpack_shared_object_once(self):
+        shared = NodeArchive('shared')
+        leaf = NodeArchive('leaf', shared, shared)
+        plist = archiver.archive(NodeArchive('root', shared, leaf))
+
+        NodeArchive.decoded.clear()
+        root = archiver.unarchive(plist)
+        self.assertIs(root.first, root.second.first)
+        self.assertIs(root.first, root.second.second)
+        self.assertEqual(['leaf', 'root', 'shared'],
+                         sorted(NodeArchive.decoded))
+
     def test_unpack_primitive_multiple_refs(self):
         expected = ['a', 'a']
         actual = archiver.unarchive(archiver.archive(['a', 'a']))
@@ -194,75 +402,60 @@ class UnarchiveTest(unittest.TestCase):
         self.assertEqual(actual, expected)
 
     def test_dataclass_not_fully_mapped(self):
-        archiver.update_class_map({
-            'FooDataclass': DataclassMissingFields,
-        })
-        try:
+        with temp_class_map({'FooDataclass': DataclassMissingFields}):
             with self.assertRaises(archive_types.Error):
                 self.unarchive('dataclass')
-        finally:
-            # Restore mapping.
-            archiver.update_class_map({
-                'FooDataclass': FooDataclass,
-            })
 
     def test_dataclass_ignore_not_fully_mapped(self):
-        archiver.update_class_map({
-            'FooDataclass': DataclassIgnoreMissingFields,
-        })
-        try:
+        with temp_class_map({'FooDataclass': DataclassIgnoreMissingFields}):
             expected = DataclassIgnoreMissingFields(int_field=5)
             actual = self.unarchive('dataclass')
             self.assertEqual(actual, expected)
-        finally:
-            # Restore mapping.
-            archiver.update_class_map({
-                'FooDataclass': FooDataclass,
-            })
 
 
 class ArchiveTest(unittest.TestCase):
 
+    @staticmethod
+    def foo_archive():
+        return FooArchive('herp', timestamp(9001), 42,
+                          ['strawberries', 'dragonfruit'],
+                          {'key': 'value'},
+                          False,
+                          None)
+
     def archive(self, obj):
         archived = archiver.archive(obj)
         unarchived = archiver.unarchive(archived)
         self.assertEqual(obj, unarchived)
 
     def test_primitive(self):
-        self.archive(True)
-        self.archive(9001)
-        self.archive('banana')
+        for obj in [True, 9001, 'banana']:
+            with self.subTest(obj=obj):
+                self.archive(obj)
 
     def test_core_types(self):
-        self.archive(1)
-        self.archive('two')
-        self.archive(3.14)
-        self.archive([1, 'two', 3.14])
-        self.archive({'fruit': 'kiwi', 'veg': 'asparagus'})
-        self.archive(b'hello')
-        self.archive({'data': b'hello'})
-        self.archive(timestamp(0))
-        self.archive([timestamp(-4)])
+        for obj in [1, 'two', 3.14, [1, 'two', 3.14],
+                    {'fruit': 'kiwi', 'veg': 'asparagus'},
+                    b'hello', {'data': b'hello'},
+                    {'fruit', 'veg'},
+                    timestamp(0), [timestamp(-4)]]:
+            with self.subTest(obj=obj):
+                self.archive(obj)
 
     def test_custom_type(self):
-        obj = FooArchive('herp', timestamp(9001), 42,
-                         ['strawberries', 'dragonfruit'],
-                         {'key': 'value'},
-                         False,
-                         None)
+        obj = self.foo_archive()
         self.archive(obj)
 
     def test_circular_ref(self):
-        obj = FooArchive('herp', timestamp(9001), 42,
-                         ['strawberries', 'dragonfruit'],
-                         {'key': 'value'},
-                         False,
-                         None)
+        obj = self.foo_archive()
         obj.recursive = obj
         plist = plistlib.loads(archiver.archive(obj))
         foo_obj = plist['$objects'][1]
         self.assertEqual(plistlib.UID(1), foo_obj['recurse'])
 
+    def test_temporary_objects(self):
+        self.archive(TemporariesArchive(1, 2))
+
     def test_dataclass(self):
         obj = FooDataclass(
             int_field=15, str_field='hello there', float_field=3.13,
@@ -270,6 +463,29 @@ class ArchiveTest(unittest.TestCase):
         )
         self.archive(obj)
 
+    def test_dataclass_bytes_fields(self):
+        obj = DataclassBytesFields(
+            data=ByteArrayArchive(b'data'),
+            maybe_data=ByteArrayArchive(b'maybe'),
+            any_data=ByteArrayArchive(b'any'),
+            not_data=ByteArrayArchive(b'not'))
+
+        unarchived = archiver.unarchive(archiver.archive(obj))
+        self.assertIs(bytes, type(unarchived.data))
+        self.assertEqual(b'data', unarchived.data)
+        self.assertIs(bytes, type(unarchived.maybe_data))
+        self.assertEqual(b'maybe', unarchived.maybe_data)
+        self.assertIs(bytes, type(unarchived.any_data))
+        self.assertEqual(b'any', unarchived.any_data)
+        self.assertIs(bytearray, type(unarchived.not_data))
+        self.assertEqual(b'not', unarchived.not_data)
+
+    def test_dataclass_subclass(self):
+        self.archive(FooDataclass(int_field=1))
+        obj = FooDataclassChild(
+            int_field=2, str_field='child', NSchild_field='extra')
+        self.archive(obj)
+
 
 if __name__ == '__main__':
     unittest.main()